@@ -1,20 +1,21 @@
 from __future__ import annotations
 from argparse import ArgumentParser
 import json
-from itertools import chain
 import math
+from types import MethodType
 
 from load_settings import settings
 from tree import *
 
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 
 
-def arrowedLine(canvas, ptA: Vec2, ptB: Vec2, width=1, color=settings['color']):
+def arrowedLine(canvas, ptA: tuple, ptB: tuple, width=1, color=settings['color']):
     """Draw line from ptA to ptB with arrowhead at ptB"""
     # Get drawing context
     # Draw the line without arrows
-    canvas.line(flatten_vectors(ptA, ptB), width=width, fill=color)
+    canvas.line((ptA, ptB), width=width, fill=color)
 
     # Now work out the arrowhead
     # = it will be a triangle with one vertex at ptB
@@ -36,9 +37,10 @@ def arrowedLine(canvas, ptA: Vec2, ptB: Vec2, width=1, color=settings['color']):
        vtx0 = (xb, yb+5)
        vtx1 = (xb, yb-5)
     else:
-       alpha = math.atan2(y1-y0,x1-x0)-90*math.pi/180
-       a = 8*math.cos(alpha)
-       b = 8*math.sin(alpha)
+       # unit normal of the line: cos(theta - pi/2) = sin(theta), sin(theta - pi/2) = -cos(theta)
+       length = math.hypot(x1-x0, y1-y0)
+       a = 8*(y1-y0)/length
+       b = -8*(x1-x0)/length
        vtx0 = (xb+a, yb+b)
        vtx1 = (xb-a, yb-b)
 
@@ -46,7 +48,7 @@ def arrowedLine(canvas, ptA: Vec2, ptB: Vec2, width=1, color=settings['color']):
     #im.save('DEBUG-base.png')              # DEBUG: save
 
     # Now draw the arrowhead triangle
-    canvas.polygon([vtx0, vtx1, ptB.as_tuple()], fill=color)
+    canvas.polygon([vtx0, vtx1, ptB], fill=color)
 
 
 class Vec2:
@@ -78,37 +80,105 @@ class Vec2:
     def __sub__(self, other: Vec2 | tuple) -> Vec2:
         if isinstance(other, Vec2):
             return Vec2(self.x - other.x, self.y - other.y)
-        if isinstance(other, tuple):
-            return Vec2(self.x - other[0], self.y - other[1])
+        return Vec2(self.x - other[0], self.y - other[1])
 
     def __add__(self, other: Vec2 | tuple) -> Vec2:
         if isinstance(other, Vec2):
             return Vec2(self.x + other.x, self.y + other.y)
-        if isinstance(other, tuple):
-            return Vec2(self.x + other[0], self.y + other[1])
-
-    def __mul__(self, other: int | float | Vec2) -> Vec2:
-        if isinstance(other, int) or isinstance(other, float):
-            return Vec2(self.x * other, self.y * other)
-        if isinstance(other, Vec2):
-            return Vec2(self.x * other.x, self.y * other.y)
+        return Vec2(self.x + other[0], self.y + other[1])
 
+    def __mul__(self, s: int | float) -> Vec2:
+        """Scale the vector. Use `hadamard` to multiply two vectors component-wise."""
+        if isinstance(s, Vec2):
+            raise TypeError('Vec2 * Vec2 is ambiguous, use Vec2.hadamard for component-wise products')
+        return Vec2(self.x * s, self.y * s)
 
     __rmul__ = __mul__
 
+    def hadamard(self, other: Vec2) -> Vec2:
+        """Multiply two vectors component-wise.
+        :param other: The vector to multiply with
+        :return: The new vector
+        """
+        return Vec2(self.x * other.x, self.y * other.y)
 
     def __repr__(self) -> str:
         return f'<x={self.x}, y={self.y}>'
 
 
-def flatten_vectors(*vectors) -> (int | float, int | float, int | float, int | float):
+# palette indices of the output image
+BACKGROUND = 0
+FOREGROUND = 1
 
-    """Join vectors together into a tuple of len(vecs) * 2 elements.
-    :param vectors: vectors to flatten
-    :return: The resulting tuple
-    """
-    return tuple(chain( (v.x, v.y) for v in vectors ))
 
+def _concat_ranges(start: np.ndarray, stop: np.ndarray) -> np.ndarray:
+    """Concatenate the integer ranges `start[i]` to `stop[i]` (inclusive) into one array."""
+    lengths = stop - start + 1
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - start, lengths)
+
+
+def stroke_rectangles(buf: np.ndarray, rects: np.ndarray, color: int | tuple) -> None:
+    """Draw the outlines of axis-aligned rectangles into a pixel buffer, clipped to the buffer like PIL does.
+    :param buf: The (height, width) or (height, width, channels) pixel buffer to draw on
+    :param rects: (k, 4) array with one (x0, y0, x1, y1) row per rectangle, corners inclusive
+    :param color: Pixel value of the outlines
+    """
+    height, width = buf.shape[:2]
+    x0, y0, x1, y1 = rects.astype(np.intp).T
+    # horizontal edges, dropping those that lie wholly outside the buffer
+    for y in (y0, y1):
+        keep = (y >= 0) & (y < height) & (x1 >= 0) & (x0 < width)
+        start, stop = np.clip(x0[keep], 0, width - 1), np.clip(x1[keep], 0, width - 1)
+        buf[np.repeat(y[keep], stop - start + 1), _concat_ranges(start, stop)] = color
+    # vertical edges
+    for x in (x0, x1):
+        keep = (x >= 0) & (x < width) & (y1 >= 0) & (y0 < height)
+        start, stop = np.clip(y0[keep], 0, height - 1), np.clip(y1[keep], 0, height - 1)
+        buf[_concat_ranges(start, stop), np.repeat(x[keep], stop - start + 1)] = color
+
+
+def compute_positions(pos_x, pos_y, children_offsets, children_idx, level_start,
+                      margin_x, margin_y, node_x, node_y, sep_x, sep_y):
+    """Calculate the top left corner of every node.
+    :param pos_x: Output array of x positions
+    :param pos_y: Output array of y positions
+    :param children_offsets: Children of node i are `children_idx[children_offsets[i]:children_offsets[i + 1]]`
+    :param children_idx: Indices of the children of every node, in node order
+    :param level_start: Nodes of level j are `level_start[j]` to `level_start[j + 1] - 1`
+    """
+    nlevels = len(level_start) - 1
+    if nlevels == 0:
+        return
+    # leaves are placed next to each other on the last level
+    j = nlevels - 1
+    leaves = np.arange(level_start[j], level_start[j + 1])
+    pos_x[leaves] = margin_x + (node_x + sep_x) * (leaves - level_start[j])
+    pos_y[leaves] = margin_y + (node_y + sep_y) * j
+    # other nodes are centered above their children
+    for j in range(nlevels - 2, -1, -1):
+        ids = np.arange(level_start[j], level_start[j + 1])
+        pos_y[ids] = margin_y + (node_y + sep_y) * j
+        counts = children_offsets[ids + 1] - children_offsets[ids]
+        parents = ids[counts > 0]
+        if len(parents) > 0:
+            # add up the k-th child of every parent at once; summing each parent's children in order
+            # (unlike np.add.reduceat) gives the same result as the scalar layout
+            starts = children_offsets[parents]
+            nchildren = counts[counts > 0]
+            sums = np.zeros(len(parents))
+            for k in range(nchildren.max()):
+                has_k = nchildren > k
+                sums[has_k] += pos_x[children_idx[starts[has_k] + k]]
+            pos_x[parents] = sums / nchildren
+        # nodes without children are placed one step right of their left neighbour
+        if len(parents) < len(ids):
+            x = margin_x
+            for (i, count) in zip(ids.tolist(), counts.tolist()):
+                if count == 0:
+                    x += node_x + sep_x
+                    pos_x[i] = x
+                else:
+                    x = pos_x[i]
 
 
 class TreeVisualizer:
@@ -120,94 +190,169 @@ class TreeVisualizer:
         self.n = settings['d']
         self.bl_size = Vec2(settings['block-width'], settings['block-height'])
         self.bl_size_2 = Vec2(settings['block-width'] - 5, settings['block-height'])
-        self.node_size = self.bl_size * Vec2(self.n, 3)
+        self.node_size = self.bl_size.hadamard(Vec2(self.n, 3))
         self.ch_size = Vec2(self.node_size.x / (self.n + 1), settings['block-height'])
         self.margin = Vec2(settings['margin'], settings['margin'])
         self.separation = Vec2(settings['horizontal-separation'], settings['vertical-separation'])
         self.font = ImageFont.truetype(settings['font-family'], settings['font-size'])
+        # offsets from the center of a text to its default (left, ascender) anchor
+        self._text_offsets = {}
+        # scalar copies of the sizes above for the drawing hot path
+        self._bl_x, self._bl_y = self.bl_size
+        self._ch_x, self._ch_y = self.ch_size
+        self._sep_x, self._sep_y = self.separation
+        # settings that are constant for the whole drawing
+        self._show_name = settings['show-name']
+        self._palette = settings.get('palette-image', False)
+        self._compress_level = settings.get('compress-level', 6)
+        self._color = settings['color']
+        self._start_row = 1 if self._show_name else 0
+        self._compute_node_shapes = self._specialize_node_shapes()
         # temporary data used when drawing graphs
         self.dimensions = None
+        self.pos = None
         self.positions = None
+        self._right_connect = None
 
-    def _draw_node(self, canvas: ImageDraw, node: Node, connect_to_parent: bool = False,
-                   connect_to_right: bool = False):
-
-        """Draw the specified node at the location recorded in `self.positions`.
+    def _draw_text(self, canvas: ImageDraw, center: tuple, text: str, fill) -> None:
+        """Draw text centered at the specified point, measuring each distinct text only once.
         :param canvas: The canvas to draw on
-        :param node: The node to be drawn
-        :param connect_to_parent: Specifies whether to draw the line connecting to the parent
-        :param connect_to_right: Specifies whether to draw the line connecting to the leaf on the right
+        :param center: The center of the text
+        :param text: The text to draw
+        :param fill: The color of the text
         """
-
-        pos = self.positions[node.name]
-
-        # draw the rectangles
-
-        start_row = 1 if settings['show-name'] else 0
-
-        # Draw the name
-        if settings['show-name']:
-            canvas.rectangle(flatten_vectors(pos, pos + self.bl_size * Vec2(self.n, 1)), outline=settings['color'])
-            center = pos + self.bl_size * Vec2(self.n, 1) * 0.5
-            canvas.text(center.as_tuple(), node.name, anchor='mm', font=self.font, fill=settings['color'])
-
-        # draw row
-        top_left = pos - (10, 0)
-        bot_right = pos + self.ch_size * Vec2(self.n, start_row + 1) - (10, 0)
-        canvas.rectangle(flatten_vectors(top_left, bot_right), outline=settings['color'])
-        # draw separators
+        offset = self._text_offsets.get(text)
+        if offset is None:
+            left, top = self.font.getbbox(text, anchor='mm')[:2]
+            la_left, la_top = self.font.getbbox(text)[:2]
+            offset = self._text_offsets[text] = (left - la_left, top - la_top)
+        canvas.text((center[0] + offset[0], center[1] + offset[1]), text, font=self.font, fill=fill)
+
+    def _specialize_node_shapes(self):
+        """Generate `_compute_node_shapes` for this visualizer's settings.
+        The block count, the show-name setting and all sizes are baked into the source as constants,
+        and the loop over the first `self.n` data items is unrolled.
+
+        The generated method has the signature
+        `_compute_node_shapes(node, texts, arrows, connect_to_parent=False, connect_to_right=False)`.
+        It computes the text and arrows of a node at the location recorded in `self.positions` without drawing
+        anything: `(center, text, fill)` tuples are appended to `texts` and `(start, end)` tuples to `arrows`,
+        to be passed to `_emit`.
+        :return: The generated method bound to `self`
+        """
+        bl_x, bl_y = self._bl_x, self._bl_y
+        start_row = self._start_row
+        src = [
+            'def _compute_node_shapes(self, node, texts, arrows, connect_to_parent=False, connect_to_right=False):',
+            '    px, py = self.positions[node.idx]',
+            '    color = self._color',
+        ]
+        # the name
+        if self._show_name:
+            src.append(f'    texts.append(((px + {bl_x * self.n * 0.5!r}, py + {bl_y * 0.5!r}), node.name, color))')
+        # the data
+        src += [
+            '    data_arr = node.data_arr',
+            '    m = len(data_arr)',
+            f'    y = py + {bl_y * (start_row + 0.55)!r}',
+        ]
         for i in range(self.n):
-            upper_left = top_left + self.bl_size * Vec2(i, start_row)
-            canvas.rectangle(flatten_vectors(upper_left, upper_left + (10, self.bl_size.y)), outline=settings['color'])
-
-        # Draw the data
-        for (i, data) in enumerate(node.data_arr):
-            center = pos + self.bl_size * Vec2(i + 0.4, start_row + 0.55)
-            if isinstance(data, list):
-                canvas.text(center.as_tuple(), str(data[0]), anchor='mm', font=self.font, fill=data[1])
-            else:
-                canvas.text(center.as_tuple(), str(data), anchor='mm', font=self.font, fill=settings['color'])
-
-        # Draw connections or lines to parent
-        if connect_to_parent and node.parent is not None:
-            child_top = pos + self.bl_size * Vec2(len(node.data_arr) / 2, 0)
-            parent_sep = self.positions[node.parent.name] + self.bl_size * Vec2(node.parent.children.index(node) + 0.5, 3 - (2 - start_row)) - (self.bl_size.x - 24, 0)
-            arrowedLine(canvas, parent_sep, child_top)
-
-        if connect_to_right and node in self.tree.nodes[-1][:-1]:
-            child_end = pos + self.ch_size * Vec2(self.n, 2.5 - (2 - start_row)) - (10, 0)
-            sibling_start = child_end + self.separation * Vec2(1.7, 0)
-            arrowedLine(canvas, child_end, sibling_start)
-            # canvas.line(flatten_vectors(start, end), fill=settings['color'], width=1)
+            src += [
+                f'    if m > {i}:',
+                f'        data = data_arr[{i}]',
+                '        if isinstance(data, list):',
+                f'            texts.append(((px + {bl_x * (i + 0.4)!r}, y), str(data[0]), data[1]))',
+                '        else:',
+                f'            texts.append(((px + {bl_x * (i + 0.4)!r}, y), str(data), color))',
+            ]
+        # nodes holding more data than the fanout allows
+        src += [
+            f'    for i in range({self.n}, m):',
+            '        data = data_arr[i]',
+            f'        center = (px + {bl_x!r} * (i + 0.4), y)',
+            '        if isinstance(data, list):',
+            '            texts.append((center, str(data[0]), data[1]))',
+            '        else:',
+            '            texts.append((center, str(data), color))',
+        ]
+        # connections or lines to parent
+        src += [
+            '    if connect_to_parent and node.parent is not None:',
+            f'        child_top = (px + {bl_x!r} * node._nhalf, py)',
+            '        ppx, ppy = self.positions[node.parent.idx]',
+            f'        parent_sep = (ppx + {bl_x!r} * (node._parent_idx + 0.5) - {bl_x - 24!r},',
+            f'                      ppy + {bl_y * (3 - (2 - start_row))!r})',
+            '        arrows.append((parent_sep, child_top))',
+            '    if connect_to_right and id(node) in self._right_connect:',
+            f'        right = px + {self._ch_x * self.n!r} - 10',
+            f'        child_end = (right, py + {self._ch_y * (2.5 - (2 - start_row))!r})',
+            f'        arrows.append((child_end, (right + {self._sep_x * 1.7!r}, child_end[1])))',
+        ]
+        namespace = {}
+        exec(compile('\n'.join(src) + '\n', '<draw>', 'exec'), namespace)
+        return MethodType(namespace['_compute_node_shapes'], self)
+
+    def _emit(self, canvas: ImageDraw, texts: list, arrows: list) -> None:
+        """Draw shapes computed by `_compute_node_shapes`.
+        :param canvas: The canvas to draw on
+        :param texts: `(center, text, fill)` tuples
+        :param arrows: `(start, end)` tuples
+        """
+        for (center, text, fill) in texts:
+            self._draw_text(canvas, center, text, fill)
+        for (start, end) in arrows:
+            arrowedLine(canvas, start, end, color=self._color)
+
+    def _node_boxes(self) -> np.ndarray:
+        """Calculate the rectangles outlining every node using the information in `self.pos`.
+        :return: (k, 4) array with one (x0, y0, x1, y1) row per rectangle
+        """
+        px, py = self.pos[:, 0], self.pos[:, 1]
+        bl_x, bl_y = self._bl_x, self._bl_y
+        start_row = self._start_row
+        left = px - 10
+        top = py + bl_y * start_row
+        # rows
+        rects = [np.stack([left, py, px + self._ch_x * self.n - 10, py + self._ch_y * (start_row + 1)], axis=1)]
+        # separators, one for each block of every node
+        x = left[:, np.newaxis] + bl_x * np.arange(self.n)
+        y = np.broadcast_to(top[:, np.newaxis], x.shape)
+        rects.append(np.stack([x, y, x + 10, y + bl_y], axis=2).reshape(-1, 4))
+        # names
+        if self._show_name:
+            rects.append(np.stack([px, py, px + bl_x * self.n, py + bl_y], axis=1))
+        return np.concatenate(rects)
 
     def _draw_tree(self, canvas: ImageDraw) -> None:
-        """Draw the entire tree using the information in `self.positions`.
+        """Draw the text and arrows of the entire tree using the information in `self.positions`.
         :param canvas: The canvas to draw on
         """
+        texts, arrows = [], []
         for level in self.tree.nodes:
             for node in level:
-                self._draw_node(canvas, node, connect_to_parent=True, connect_to_right=True)
+                self._compute_node_shapes(node, texts, arrows, connect_to_parent=True, connect_to_right=True)
+        self._emit(canvas, texts, arrows)
 
     def analyze_tree(self) -> None:
         """Calculate the dimensions of the image and positions of each node."""
         count = Vec2(self.tree.nleaves(), self.tree.nlevels())
-        self.dimensions = self.margin * 2 + self.node_size * count + self.separation * (count + Vec2(-1, -1))
-        j = count.y - 1
-        # calculate position of leaves
-        self.positions = {
-            leaf.name: self.margin + (self.node_size + self.separation) * Vec2(i, j)
-            for (i, leaf) in enumerate(self.tree.nodes[-1])
-        }
-        # calculate position of other nodes
-        for level in reversed(self.tree.nodes[:-1]):
-            j -= 1
-            pos = self.margin + (self.node_size.y + self.separation.y) * Vec2(0, j)
-            for node in level:
-                if len(node.children) == 0:
-                    pos.x += (self.node_size.x + self.separation.x)
-                else:
-                    pos.x = sum([self.positions[child.name].x for child in node.children]) / len(node.children)
-                self.positions[node.name] = pos.clone()
+        self.dimensions = self.margin * 2 + self.node_size.hadamard(count) + self.separation.hadamard(count + Vec2(-1, -1))
+        # flatten the tree into arrays indexed by `Node.idx` (assigned level by level)
+        nodes = [node for level in self.tree.nodes for node in level]
+        children_offsets = np.zeros(len(nodes) + 1, dtype=np.int32)
+        np.cumsum([len(node.children) for node in nodes], out=children_offsets[1:])
+        children_idx = np.fromiter((child.idx for node in nodes for child in node.children),
+                                   dtype=np.int32, count=children_offsets[-1])
+        level_start = np.zeros(len(self.tree.nodes) + 1, dtype=np.int32)
+        np.cumsum([len(level) for level in self.tree.nodes], out=level_start[1:])
+        # every leaf except the last one points to its right sibling
+        self._right_connect = {id(leaf) for leaf in self.tree.nodes[-1][:-1]}
+        self.pos = np.empty((len(nodes), 2), dtype=np.float64)
+        compute_positions(self.pos[:, 0], self.pos[:, 1], children_offsets, children_idx, level_start,
+                          float(self.margin.x), float(self.margin.y), float(self.node_size.x),
+                          float(self.node_size.y), float(self.separation.x), float(self.separation.y))
+        # plain float tuples for the per-node drawing code
+        self.positions = list(zip(self.pos[:, 0].tolist(), self.pos[:, 1].tolist()))
 
     def export(self, path: str) -> None:
         """Export the image in PNG format to a file.
@@ -215,10 +360,25 @@ class TreeVisualizer:
         """
         self.analyze_tree()
         print(self.dimensions)
-        with Image.new('RGB', self.dimensions.as_tuple(), settings['background']) as image:
+        boxes = self._node_boxes()
+        if self._palette:
+            # the boxes are stroked into a buffer of one byte palette indices
+            width, height = self.dimensions
+            buf = np.full((height, width), BACKGROUND, dtype=np.uint8)
+            stroke_rectangles(buf, boxes, FOREGROUND)
+            image = Image.fromarray(buf)
+            del buf
+            # PIL adds the colors of colored data to the palette as they are drawn
+            image.putpalette(ImageColor.getrgb(settings['background']) + ImageColor.getrgb(self._color))
+        else:
+            image = Image.new('RGB', self.dimensions.as_tuple(), settings['background'])
+        with image:
             canvas = ImageDraw.Draw(image)
+            if not self._palette:
+                for box in boxes.tolist():
+                    canvas.rectangle(box, outline=self._color)
             self._draw_tree(canvas)
-            image.save(path, 'PNG')
+            image.save(path, 'PNG', compress_level=self._compress_level)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageColor, ImageDraw
+
+import draw
+from tree import Tree
+
+GOLDEN_DIR = Path(__file__).parent / 'golden'
+
+
+def test_stroke_rectangles_clips_like_pil():
+    rects = [(-15.5, 5, 20, 30), (30, -8, 70.2, 12), (-20, -20, 80, 60), (10, 35.5, 45, 52), (60, 5, 90, 30)]
+    expected = Image.new('L', (50, 40))
+    canvas = ImageDraw.Draw(expected)
+    for rect in rects:
+        canvas.rectangle(rect, outline=255)
+    buf = np.zeros((40, 50), dtype=np.uint8)
+    draw.stroke_rectangles(buf, np.array(rects, dtype=np.float64), 255)
+    assert np.array_equal(buf, np.array(expected))
+
+
+def render(tmp_path, tree_array) -> np.ndarray:
+    tree = Tree()
+    tree.load(tree_array)
+    path = tmp_path / 'out.png'
+    draw.TreeVisualizer(tree).export(str(path))
+    with Image.open(path) as image:
+        return np.array(image.convert('RGB'))
+
+
+def golden(name: str) -> np.ndarray:
+    # reference images in golden/ were rendered by the original implementation
+    with Image.open(GOLDEN_DIR / f'{name}.png') as image:
+        return np.array(image.convert('RGB'))
+
+
+@pytest.mark.parametrize('palette', [False, True])
+def test_export_childless_inner_node(tmp_path, monkeypatch, palette):
+    monkeypatch.setitem(draw.settings, 'palette-image', palette)
+    # the childless inner nodes are placed past the right edge of the image and must be clipped
+    pixels = render(tmp_path, [[[1]], [[1], [2], [3], [4]], [[5]]])
+    expected = golden('childless')
+    if palette:
+        # text is not antialiased in palette images, so only antialiased text pixels may differ
+        antialiased = np.ones(expected.shape[:2], dtype=bool)
+        for key in ('background', 'color'):
+            antialiased &= (expected != ImageColor.getrgb(draw.settings[key])).any(axis=-1)
+        assert pixels.shape == expected.shape
+        assert not ((pixels != expected).any(axis=-1) & ~antialiased).any()
+    else:
+        assert np.array_equal(pixels, expected)
+
+
+@pytest.mark.parametrize('palette', [False, True])
+def test_export_zero_margin(tmp_path, monkeypatch, palette):
+    monkeypatch.setitem(draw.settings, 'margin', 0)
+    monkeypatch.setitem(draw.settings, 'palette-image', palette)
+    tree = Tree()
+    tree.load([[[25, 65, 102]], [[3, 16], [27, 35, 46], [65, 66, 88]]])
+    vis = draw.TreeVisualizer(tree)
+    path = tmp_path / 'out.png'
+    vis.export(str(path))
+    with Image.open(path) as image:
+        pixels = np.array(image)
+    # boxes starting left of the image must not wrap around to its right edge
+    background = draw.BACKGROUND if palette else ImageColor.getrgb(draw.settings['background'])
+    assert (pixels[:, -10:] == background).all()
+
+
+def test_load_assigns_parents_in_level_order():
+    tree = Tree()
+    tree.load([[[10, 20]], [[5], [15], [25, 30]]])
+    tree.load([[[1], [6], [11], [16], [21], [26], [28]], [[0]] * 14], append=True)
+    nodes = [node for level in tree.nodes for node in level]
+    assert [node.idx for node in nodes] == list(range(len(nodes)))
+    assert tree.nnodes() == len(nodes) == 25
+    assert tree.nleaves() == 14
+    # every parent takes len(data) + 1 children, left to right
+    for (parents, children) in zip(tree.nodes, tree.nodes[1:]):
+        expected = iter(children)
+        for parent in parents:
+            assert parent.children == [next(expected) for _ in range(len(parent.data_arr) + 1)]
+            for (i, child) in enumerate(parent.children):
+                assert child.parent is parent
+                assert child._parent_idx == i
+        assert next(expected, None) is None
+    assert tree.root().parent is None
+
+
+# keys 7 and 25 are colored and the middle leaf holds more data than d = 4 allows
+COLORED_TREE = [[[10, 20]], [[3, [7, '#FF4040']], [12, 15, 17, 19, 21], [[25, '#40FF40']]]]
+
+
+@pytest.mark.parametrize(('name', 'tree_array', 'd', 'show_name'), [
+    ('tree_d4', COLORED_TREE, 4, False),
+    ('tree_d4_names', COLORED_TREE, 4, True),
+    ('tree_d2', COLORED_TREE, 2, False),
+    ('tree_d2_names', COLORED_TREE, 2, True),
+    ('single_names', [[[1, 2]]], 4, True),
+])
+def test_export_matches_golden(tmp_path, monkeypatch, name, tree_array, d, show_name):
+    monkeypatch.setitem(draw.settings, 'd', d)
+    monkeypatch.setitem(draw.settings, 'show-name', show_name)
+    assert np.array_equal(render(tmp_path, tree_array), golden(name))
+
+
+def test_optional_settings_default(tmp_path, monkeypatch):
+    # settings files written before these keys existed must keep working
+    monkeypatch.delitem(draw.settings, 'palette-image')
+    monkeypatch.delitem(draw.settings, 'compress-level')
+    pixels = render(tmp_path, [[[1]], [[1], [2], [3], [4]], [[5]]])
+    assert np.array_equal(pixels, golden('childless'))
@@ -4,6 +4,8 @@ from load_settings import settings
 
 
 class Node:
+    __slots__ = 'name', 'data_arr', 'parent', 'children', '_capacity', '_nhalf', '_parent_idx', 'idx'
+
     def __init__(self, name: str, data_arr: list, parent: Node | None = None) -> None:
         """Create a single node of a tree.
 
@@ -14,6 +16,13 @@ class Node:
         self.name = name
         self.data_arr = data_arr
         self.parent = parent
+        # index into flat per-node arrays, assigned by `Tree.load`
+        self.idx = None
+        self._capacity = len(data_arr) + 1
+        # half the number of data, where the arrow from the parent points to
+        self._nhalf = len(data_arr) * 0.5
+        # position of this node in `parent.children`
+        self._parent_idx = None
         if parent is not None:
             parent._add_child(self)
         self.children = []
@@ -30,6 +39,7 @@ class Node:
 
         :param child: The node to add as child
         """
+        child._parent_idx = len(self.children)
         self.children.append(child)
 
     def is_full(self) -> bool:
@@ -37,7 +47,7 @@ class Node:
 
         :return: `True` if having at least one more children than data
         """
-        return len(self.children) >= len(self.data_arr) + 1
+        return len(self.children) >= self._capacity
 
     def __repr__(self) -> str:
         parent = '' if self.parent is None else f'({self.parent.name})'
@@ -49,6 +59,8 @@ class Tree:
         """Creates an empty tree."""
         self.nodes = []
         self.enumi = 0
+        self._nnodes = 0
+        self._nleaves = 0
 
     def load(self, tree_array: list[list[list]], *, append: bool = False) -> None:
         """Create new nodes from a given tree array.
@@ -61,16 +73,27 @@ class Tree:
             self.enumi = 0
 
         for level in tree_array:
+            # children are handed out to the parents from left to right
+            parents = self.nodes[-1]
+            plen = len(parents)
+            slots = [p._capacity - len(p.children) for p in parents]
             i = 0
             new_level = []
 
             for data_arr in level:
-                name = settings['node-name'].format(self.enumi)
+                idx = self.enumi
+                name = settings['node-name'].format(idx)
                 self.enumi += 1
-                while i < len(self.nodes[-1]) and self.nodes[-1][i].is_full():
+                while i < plen and slots[i] <= 0:
                     i += 1
-                parent = self.nodes[-1][i] if i < len(self.nodes[-1]) else None
-                new_level.append(Node(name, data_arr, parent))
+                if i < plen:
+                    parent = parents[i]
+                    slots[i] -= 1
+                else:
+                    parent = None
+                node = Node(name, data_arr, parent)
+                node.idx = idx
+                new_level.append(node)
 
             if len(self.nodes[-1]) == 0:
                 self.nodes.pop(-1)
@@ -79,6 +102,9 @@ class Tree:
         if len(self.nodes[-1]) == 0:
             self.nodes.pop(-1)
 
+        self._nnodes = sum(len(level) for level in self.nodes)
+        self._nleaves = 0 if len(self.nodes) == 0 else len(self.nodes[-1])
+
     def nlevels(self) -> int:
         """Find the number of levels in the tree.
 
@@ -91,14 +117,14 @@ class Tree:
 
         :return: Number of nodes
         """
-        return sum([len(level) for level in self.nodes])
+        return self._nnodes
 
     def nleaves(self) -> int:
         """Find the number of leaves in the tree
 
         :return: Number of leaves
         """
-        return 0 if len(self.nodes) == 0 else len(self.nodes[-1])
+        return self._nleaves
 
     def root(self) -> Node | None:
         """Find the root of the tree.